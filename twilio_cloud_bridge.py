@@ -4,12 +4,16 @@ This creates rooms and lets LiveKit Cloud Agents handle the agent deployment
 """
 
 import asyncio
-import json
 import logging
-import base64
-import audioop
+import time
+import binascii
 import uuid
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Optional
+import numpy as np
+import orjson
+from numba import njit
 from fastapi import FastAPI, WebSocket, Form, Request
 from fastapi.responses import PlainTextResponse
 from twilio.twiml.voice_response import VoiceResponse
@@ -31,8 +35,130 @@ LIVEKIT_API_SECRET = os.getenv("LIVEKIT_API_SECRET")
 LIVEKIT_URL = os.getenv("LIVEKIT_URL")
 PUBLIC_URL = os.getenv("PUBLIC_URL", "ws://localhost:8000")
 
+# Twilio media streams carry fixed 20 ms mu-law chunks (160 samples at 8 kHz)
+TWILIO_SAMPLE_RATE = 8000
+TWILIO_SAMPLES_PER_FRAME = 160
+
+# Inbound Twilio chunks are coalesced into frames of this length before capture
+TWILIO_COALESCE_MS = int(os.getenv("TWILIO_COALESCE_MS", 80))
+INBOUND_FRAME_SAMPLES = max(1, TWILIO_COALESCE_MS // 20) * TWILIO_SAMPLES_PER_FRAME
+
+# Number of agent audio frames coalesced into a single outbound media message
+TWILIO_OUTBOUND_BATCH_FRAMES = int(os.getenv("TWILIO_OUTBOUND_BATCH_FRAMES", 4))
+
+# G.711 mu-law conversions, bit-exact with the former audioop implementation
+@njit(nogil=True, cache=True)
+def ulaw_decode(src: np.ndarray, dst: np.ndarray) -> None:
+    """Decode mu-law bytes from src into 16-bit PCM samples in dst"""
+    for i in range(src.shape[0]):
+        ulaw = ~np.int32(src[i]) & 0xFF
+        exponent = (ulaw >> 4) & 0x07
+        mantissa = ulaw & 0x0F
+        magnitude = (((mantissa << 3) + 0x84) << exponent) - 0x84
+        dst[i] = -magnitude if ulaw & 0x80 else magnitude
+
+def _build_ulaw_encode_table() -> np.ndarray:
+    """Build the 65536-entry 16-bit PCM -> mu-law byte table, indexed by the sample as uint16"""
+    pcm = np.arange(65536, dtype=np.uint16).view(np.int16).astype(np.int32) >> 2
+    mask = np.where(pcm < 0, 0x7F, 0xFF)
+    magnitude = np.minimum(np.abs(pcm), 8159) + 0x21
+    segment = np.floor(np.log2(magnitude)).astype(np.int32) - 5
+    ulaw = (segment << 4) | ((magnitude >> (segment + 1)) & 0x0F)
+    ulaw = np.where(segment > 7, 0x7F, ulaw)
+    return (ulaw ^ mask).astype(np.uint8)
+
+PCM2ULAW = _build_ulaw_encode_table()
+
+# Outbound encoding runs here so the event loop only handles I/O; os.cpu_count()
+# reports the host rather than the container quota, so the size is configured
+ENCODE_WORKERS = int(os.getenv("ENCODE_WORKERS", 2))
+ENCODE_POOL = ThreadPoolExecutor(max_workers=ENCODE_WORKERS)
+
+def encode_ulaw_b64(pcm_data) -> str:
+    """Encode 16-bit PCM to mu-law and return it base64-encoded for a Twilio media payload"""
+    pcm = np.frombuffer(pcm_data, dtype=np.int16)
+    mulaw_data = PCM2ULAW[pcm.view(np.uint16)]
+    return binascii.b2a_base64(mulaw_data, newline=False).decode("ascii")
+
+# Calls whose media stream never connects are dropped after this long
+MAX_CALL_SECONDS = float(os.getenv("MAX_CALL_SECONDS", 3600))
+SWEEP_INTERVAL_SECONDS = 60
+
+@dataclass(slots=True)
+class CallState:
+    """Per-call connection info kept between the voice webhook and the media stream"""
+    room_name: str
+    token: str
+    created_at: float
+    media_connected: bool = False
+
 # Store active connections
-active_connections: Dict[str, dict] = {}
+active_connections: Dict[str, CallState] = {}
+_sweeper_task: Optional[asyncio.Task] = None
+
+# Shared LiveKit API client, created on first use
+_LK_API: Optional[api.LiveKitAPI] = None
+
+def get_lk_api() -> api.LiveKitAPI:
+    """Return the process-wide LiveKit API client so calls share one connection pool"""
+    global _LK_API
+    if _LK_API is None:
+        _LK_API = api.LiveKitAPI(
+            url=LIVEKIT_URL,
+            api_key=LIVEKIT_API_KEY,
+            api_secret=LIVEKIT_API_SECRET,
+        )
+    return _LK_API
+
+@app.on_event("startup")
+async def warm_up_codecs():
+    """Compile the mu-law decoder before the first call arrives"""
+    # Decoded payloads are read-only buffers, so warm up with the same array type
+    ulaw_decode(np.frombuffer(bytes(TWILIO_SAMPLES_PER_FRAME), dtype=np.uint8), np.empty(TWILIO_SAMPLES_PER_FRAME, dtype=np.int16))
+
+async def sweep_stale_connections():
+    """Periodically drop calls whose media stream has not connected within MAX_CALL_SECONDS"""
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL_SECONDS)
+        cutoff = time.monotonic() - MAX_CALL_SECONDS
+        stale = [
+            sid for sid, state in active_connections.items()
+            if not state.media_connected and state.created_at < cutoff
+        ]
+        for sid in stale:
+            del active_connections[sid]
+        if stale:
+            logger.info("Dropped %s stale call(s)", len(stale))
+
+@app.on_event("startup")
+async def log_event_loop():
+    """Log which event loop implementation uvicorn is running on"""
+    logger.info("Event loop: %s", type(asyncio.get_running_loop()).__module__)
+
+@app.on_event("startup")
+async def start_sweeper():
+    """Start the stale connection sweeper"""
+    global _sweeper_task
+    _sweeper_task = asyncio.create_task(sweep_stale_connections())
+
+@app.on_event("shutdown")
+async def stop_sweeper():
+    """Stop the stale connection sweeper"""
+    if _sweeper_task is not None:
+        _sweeper_task.cancel()
+
+@app.on_event("shutdown")
+async def stop_encode_pool():
+    """Stop the outbound audio encoding threads"""
+    ENCODE_POOL.shutdown(wait=False)
+
+@app.on_event("shutdown")
+async def close_lk_api():
+    """Close the shared LiveKit API client"""
+    global _LK_API
+    if _LK_API is not None:
+        await _LK_API.aclose()
+        _LK_API = None
 
 class TwilioCloudBridge:
     """
@@ -42,11 +168,7 @@ class TwilioCloudBridge:
     def __init__(self, call_sid: str):
         self.call_sid = call_sid
         self.room_name = f"twilio-call-{call_sid}"
-        self.livekit_api = api.LiveKitAPI(
-            url=LIVEKIT_URL,
-            api_key=LIVEKIT_API_KEY,
-            api_secret=LIVEKIT_API_SECRET,
-        )
+        self.livekit_api = get_lk_api()
         self.room = None
         
     async def create_room(self):
@@ -56,7 +178,7 @@ class TwilioCloudBridge:
             room_info = await self.livekit_api.room.create_room(
                 api.CreateRoomRequest(name=self.room_name)
             )
-            logger.info(f"Created room: {self.room_name}")
+            logger.info("Created room: %s", self.room_name)
             
             # Create participant token for Twilio
             token = api.AccessToken(LIVEKIT_API_KEY, LIVEKIT_API_SECRET)
@@ -74,7 +196,7 @@ class TwilioCloudBridge:
             }
             
         except Exception as e:
-            logger.error(f"Failed to create room: {e}")
+            logger.error("Failed to create room: %s", e)
             return None
 
 @app.post("/twilio/voice")
@@ -83,7 +205,7 @@ async def handle_voice_webhook(request: Request):
     form_data = await request.form()
     call_sid = form_data.get("CallSid")
     
-    logger.info(f"Incoming call: {call_sid}")
+    logger.info("Incoming call: %s", call_sid)
     
     # Create LiveKit room for this call
     bridge = TwilioCloudBridge(call_sid)
@@ -96,11 +218,11 @@ async def handle_voice_webhook(request: Request):
         return PlainTextResponse(str(response), media_type="application/xml")
     
     # Store connection info
-    active_connections[call_sid] = {
-        "room_name": room_info["room_name"],
-        "token": room_info["token"],
-        "created_at": asyncio.get_event_loop().time()
-    }
+    active_connections[call_sid] = CallState(
+        room_name=room_info["room_name"],
+        token=room_info["token"],
+        created_at=time.monotonic(),
+    )
     
     # Create TwiML response to start media stream
     response = VoiceResponse()
@@ -110,61 +232,178 @@ async def handle_voice_webhook(request: Request):
     start = response.start()
     start.stream(
         url=f"wss://{request.headers.get('host', 'localhost')}/twilio/media/{call_sid}",
-        track="both_tracks"
+        track="inbound_track"
     )
     
     return PlainTextResponse(str(response), media_type="application/xml")
 
+# Compact Twilio media events can have their payload sliced out without a JSON parse
+_MEDIA_EVENT_MARKER = '"event":"media"'
+_INBOUND_TRACK_MARKER = '"track":"inbound"'
+_PAYLOAD_KEY = '"payload":"'
+
+def extract_media_payload(message) -> Optional[str]:
+    """Return the base64 payload of an inbound media event, or None if the message needs a full parse"""
+    if not isinstance(message, str) or _MEDIA_EVENT_MARKER not in message or _INBOUND_TRACK_MARKER not in message:
+        return None
+    start = message.find(_PAYLOAD_KEY)
+    if start < 0:
+        return None
+    start += len(_PAYLOAD_KEY)
+    end = message.find('"', start)
+    if end < 0:
+        return None
+    return message[start:end]
+
+class InboundAudio:
+    """
+    Coalesces Twilio's 20 ms chunks into one reused frame of INBOUND_FRAME_SAMPLES
+    and pushes it to LiveKit each time it fills up
+    """
+    __slots__ = ("audio_source", "frame", "frame_pcm", "filled")
+    
+    def __init__(self, audio_source: rtc.AudioSource):
+        self.audio_source = audio_source
+        self.frame = rtc.AudioFrame.create(TWILIO_SAMPLE_RATE, 1, INBOUND_FRAME_SAMPLES)
+        self.frame_pcm = np.frombuffer(self.frame.data, dtype=np.int16)
+        self.filled = 0
+    
+    async def push(self, ulaw: np.ndarray):
+        """Decode mu-law samples into the pending frame, capturing it whenever it is full"""
+        while ulaw.size:
+            count = min(ulaw.size, INBOUND_FRAME_SAMPLES - self.filled)
+            ulaw_decode(ulaw[:count], self.frame_pcm[self.filled:self.filled + count])
+            self.filled += count
+            ulaw = ulaw[count:]
+            
+            if self.filled == INBOUND_FRAME_SAMPLES:
+                await self.audio_source.capture_frame(self.frame)
+                self.filled = 0
+    
+    async def flush(self):
+        """Capture a partially filled frame, e.g. when the stream stops"""
+        if not self.filled:
+            return
+        tail = rtc.AudioFrame.create(TWILIO_SAMPLE_RATE, 1, self.filled)
+        np.frombuffer(tail.data, dtype=np.int16)[:] = self.frame_pcm[:self.filled]
+        self.filled = 0
+        await self.audio_source.capture_frame(tail)
+
+async def push_media_payload(payload, inbound: InboundAudio):
+    """Decode a base64 mu-law chunk from Twilio and queue it for LiveKit"""
+    try:
+        audio_data = binascii.a2b_base64(payload)
+    except binascii.Error as e:
+        logger.error("Skipping corrupt media payload: %s", e)
+        return
+    await inbound.push(np.frombuffer(audio_data, dtype=np.uint8))
+
+async def _handle_media(data: dict, inbound: InboundAudio) -> bool:
+    """Push the caller audio of a parsed Twilio media event to LiveKit"""
+    media = data.get("media")
+    if not isinstance(media, dict) or media.get("track", "inbound") != "inbound":
+        return False
+    payload = media.get("payload")
+    if isinstance(payload, str) and payload:
+        await push_media_payload(payload, inbound)
+    return False
+
+async def _handle_start(data: dict, inbound: InboundAudio) -> bool:
+    """Log the start of the Twilio media stream"""
+    logger.info("Twilio media stream started")
+    return False
+
+async def _handle_stop(data: dict, inbound: InboundAudio) -> bool:
+    """Flush pending audio, log the end of the Twilio media stream and stop reading it"""
+    await inbound.flush()
+    logger.info("Twilio media stream stopped")
+    return True
+
+# Twilio stream event -> handler; a handler returns True to end the stream
+TWILIO_EVENT_HANDLERS = {
+    "media": _handle_media,
+    "start": _handle_start,
+    "stop": _handle_stop,
+}
+
 @app.websocket("/twilio/media/{call_sid}")
 async def handle_media_stream(websocket: WebSocket, call_sid: str):
     """Handle Twilio media stream WebSocket"""
     await websocket.accept()
-    logger.info(f"Media stream connected for call: {call_sid}")
+    logger.info("Media stream connected for call: %s", call_sid)
     
     # Get room info
-    room_info = active_connections.get(call_sid)
-    if not room_info:
-        logger.error(f"No room info found for call: {call_sid}")
+    call_state = active_connections.get(call_sid)
+    if not call_state:
+        logger.error("No room info found for call: %s", call_sid)
         await websocket.close()
         return
+    call_state.media_connected = True
+    
+    # Tasks forwarding agent audio to Twilio, cancelled when the stream ends
+    agent_audio_tasks = set()
     
     try:
         # Connect to LiveKit room
         room = rtc.Room()
         
-        async def on_participant_connected(participant: rtc.RemoteParticipant):
-            logger.info(f"Participant connected: {participant.identity}")
+        def on_participant_connected(participant: rtc.RemoteParticipant):
+            logger.info("Participant connected: %s", participant.identity)
         
-        async def on_track_subscribed(track: rtc.Track, publication: rtc.TrackPublication, participant: rtc.RemoteParticipant):
-            logger.info(f"Track subscribed: {track.kind}")
-            if track.kind == rtc.TrackKind.KIND_AUDIO:
-                # Handle audio from LiveKit agent
-                audio_stream = rtc.AudioStream(track)
-                async for frame in audio_stream:
-                    # Convert and send to Twilio
-                    audio_data = frame.data.tobytes()
-                    # Convert to mulaw and base64 encode
-                    mulaw_data = audioop.lin2ulaw(audio_data, 2)
-                    b64_audio = base64.b64encode(mulaw_data).decode()
+        async def forward_agent_audio(track: rtc.Track):
+            # Handle audio from LiveKit agent, resampled by LiveKit to Twilio's 8kHz mono
+            audio_stream = rtc.AudioStream(track, sample_rate=TWILIO_SAMPLE_RATE, num_channels=1)
+            try:
+                # Reused across batches; only the payload changes
+                pcm_batch = bytearray()
+                message_prefix = (
+                    '{"event":"media","streamSid":'
+                    + orjson.dumps(call_sid).decode()
+                    + ',"media":{"payload":"'
+                )
+                message_suffix = '"}}'
+                loop = asyncio.get_running_loop()
+                
+                async def send_pcm(pcm_data):
+                    b64_audio = await loop.run_in_executor(ENCODE_POOL, encode_ulaw_b64, pcm_data)
+                    await websocket.send_text(message_prefix + b64_audio + message_suffix)
+                
+                # Coalesce several frames per message to cut WebSocket/TLS framing overhead
+                batched = 0
+                async for event in audio_stream:
+                    # Append straight from the frame's buffer, without a tobytes() copy
+                    pcm_batch += event.frame.data.cast("B")
+                    batched += 1
                     
-                    media_message = {
-                        "event": "media",
-                        "streamSid": call_sid,
-                        "media": {
-                            "payload": b64_audio
-                        }
-                    }
-                    await websocket.send_text(json.dumps(media_message))
+                    if batched >= TWILIO_OUTBOUND_BATCH_FRAMES:
+                        # Convert and send to Twilio
+                        await send_pcm(pcm_batch)
+                        pcm_batch.clear()
+                        batched = 0
+                
+                # Flush whatever is left once the agent track ends
+                if pcm_batch:
+                    await send_pcm(pcm_batch)
+            finally:
+                await audio_stream.aclose()
+        
+        def on_track_subscribed(track: rtc.Track, publication: rtc.TrackPublication, participant: rtc.RemoteParticipant):
+            # Event callbacks must be sync; the audio forwarding runs as its own task
+            logger.info("Track subscribed: %s", track.kind)
+            if track.kind == rtc.TrackKind.KIND_AUDIO:
+                task = asyncio.create_task(forward_agent_audio(track))
+                agent_audio_tasks.add(task)
+                task.add_done_callback(agent_audio_tasks.discard)
         
         room.on("participant_connected", on_participant_connected)
         room.on("track_subscribed", on_track_subscribed)
         
         # Connect to room
-        await room.connect(LIVEKIT_URL, room_info["token"])
-        logger.info(f"Connected to LiveKit room: {room_info['room_name']}")
+        await room.connect(LIVEKIT_URL, call_state.token)
+        logger.info("Connected to LiveKit room: %s", call_state.room_name)
         
         # Create audio source for incoming Twilio audio
-        audio_source = rtc.AudioSource(24000, 1)  # 24kHz mono
+        audio_source = rtc.AudioSource(TWILIO_SAMPLE_RATE, 1)  # 8kHz mono, Twilio's native rate
         track = rtc.LocalAudioTrack.create_audio_track("twilio-audio", audio_source)
         options = rtc.TrackPublishOptions()
         options.source = rtc.TrackSource.SOURCE_MICROPHONE
@@ -172,42 +411,42 @@ async def handle_media_stream(websocket: WebSocket, call_sid: str):
         publication = await room.local_participant.publish_track(track, options)
         logger.info("Published audio track to LiveKit")
         
+        # One reused frame per call, refilled in place from Twilio's chunks
+        inbound = InboundAudio(audio_source)
+        
         # Handle incoming Twilio media
+        get_handler = TWILIO_EVENT_HANDLERS.get
         async for message in websocket.iter_text():
+            payload = extract_media_payload(message)
+            if payload:
+                await push_media_payload(payload, inbound)
+                continue
+            
             try:
-                data = json.loads(message)
-                
-                if data.get("event") == "media":
-                    # Decode audio from Twilio
-                    payload = data["media"]["payload"]
-                    audio_data = base64.b64decode(payload)
-                    
-                    # Convert from mulaw to PCM
-                    pcm_data = audioop.ulaw2lin(audio_data, 2)
-                    
-                    # Create audio frame and push to LiveKit
-                    frame = rtc.AudioFrame.create(24000, 1, len(pcm_data) // 2)
-                    frame.data[:] = pcm_data
-                    
-                    await audio_source.capture_frame(frame)
-                    
-                elif data.get("event") == "start":
-                    logger.info("Twilio media stream started")
-                    
-                elif data.get("event") == "stop":
-                    logger.info("Twilio media stream stopped")
-                    break
-                    
-            except Exception as e:
-                logger.error(f"Error processing media: {e}")
+                data = orjson.loads(message)
+            except orjson.JSONDecodeError as e:
+                logger.error("Ignoring malformed Twilio message: %s", e)
+                continue
+            if not isinstance(data, dict):
                 continue
+            
+            event = data.get("event")
+            if not isinstance(event, str):
+                continue
+            
+            handler = get_handler(event)
+            if handler and await handler(data, inbound):
+                break
                 
     except Exception as e:
-        logger.error(f"Error in media stream: {e}")
+        logger.error("Error in media stream: %s", e)
     finally:
         # Cleanup
-        if call_sid in active_connections:
-            del active_connections[call_sid]
+        active_connections.pop(call_sid, None)
+        
+        for task in list(agent_audio_tasks):
+            task.cancel()
+        await asyncio.gather(*agent_audio_tasks, return_exceptions=True)
         
         try:
             await room.disconnect()
@@ -215,7 +454,7 @@ async def handle_media_stream(websocket: WebSocket, call_sid: str):
             pass
         
         await websocket.close()
-        logger.info(f"Media stream closed for call: {call_sid}")
+        logger.info("Media stream closed for call: %s", call_sid)
 
 @app.get("/health")
 async def health_check():
@@ -243,11 +482,15 @@ async def root():
 
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
     port = int(os.getenv("PORT", 8000))
     uvicorn.run(
         app, 
         host="0.0.0.0", 
         port=port,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        ws="websockets",
         log_level="info"
     )